@@ -3,15 +3,25 @@
 """Build a backup on Dropbox."""
 
 import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
 import logging
 import os
 import pathlib
+import queue
+import re
 import shutil
-import subprocess
+import stat
 import tarfile
+import threading
+import time
 from collections import Counter
 
 import yaml  # fades
+import zstandard  # fades
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -24,6 +34,38 @@ logger.addHandler(_h)
 MB = 1024 ** 2
 GB = 1024 ** 3
 
+# buffer size used when reading the files and writing the blobs
+TAR_BUFSIZE = MB
+
+# files up to this size are read ahead while the previous ones are compressed, keeping up
+# to this amount of them in memory
+READ_AHEAD_MAXSIZE = MB
+READ_AHEAD_QUEUE_SIZE = 8
+
+# amount of uncompressed data after which a new zstd frame is started in the blobs
+ZSTD_FRAME_SIZE = 4 * MB
+
+# size of the blocks read when comparing files' content
+COMPARE_BLOCKSIZE = 256 * 1024
+
+# trees smaller than this are packed in a single blob, even if configured to be grouped in
+# deeper levels
+SMALL_TREE_SIZE = 32 * MB
+
+# suffix for the files, stored next to each built one, holding its content's digest (and
+# the size and modification time it had, to know if the digest is still for it)
+DIGEST_SUFFIX = '.blake2'
+
+# suffix for the files, stored next to each blob of a tree, holding the tree's path, when
+# the blob was started to build, its digest and the nodes ignored inside it; and the margin
+# to use on that time, as the file system timestamps are coarser than the clock
+STAMP_SUFFIX = '.stamp'
+STAMP_MARGIN_NS = 2 * 10 ** 9
+
+# cached to avoid even calling the logger in the loops that run for every file (refreshed
+# after parsing the command line)
+_DEBUG = logger.isEnabledFor(logging.DEBUG)
+
 DROPBOX_FORBIDDEN = {'"', '*', '/', ':', '<', '>', '?', '\\', '|'}
 
 
@@ -33,6 +75,11 @@ def _encode(char):
     return '%' * pq + in_hex.upper()
 
 
+# to find, in one pass, all the chars that need to be encoded (forbidden or outside the BMP)
+_TO_ENCODE_RE = re.compile(
+    '[' + re.escape(''.join(sorted(DROPBOX_FORBIDDEN))) + r']|[^\u0000-\uffff]')
+
+
 def sanitize(name):
     """Sanitize the name, get something that is really allowed in Dropbox.
 
@@ -41,85 +88,339 @@ def sanitize(name):
     - `.` (dot) or ` ` (space) as last character of the name
     - anything not in Unicode Basic Multilingual Plane I (i.e. ord() > 2**16)
     """
-    final_chars = []
-    for char in name:
-        if char in DROPBOX_FORBIDDEN or ord(char) > 65535:
-            final_chars.append(_encode(char))
-        else:
-            final_chars.append(char)
-    if final_chars[-1] in '. ':
-        final_chars[-1] = _encode(final_chars[-1])
+    final_name = _TO_ENCODE_RE.sub(lambda match: _encode(match.group()), name)
+    if final_name[-1] in '. ':
+        final_name = final_name[:-1] + _encode(final_name[-1])
 
-    final_name = ''.join(final_chars)
-    if final_name != name:
+    if _DEBUG and final_name != name:
         logger.debug("=== sanitized name %r -> %r", name, final_name)
     return final_name
 
 
 def _get_name(basename, directory):
-    """Get a name based on basename and extension that is not yet in the directory."""
-    fpath = pathlib.Path("{}.tar.bz2".format(basename))
+    """Get a name based on basename and extension that is not yet in the directory.
+
+    The file is created empty to reserve the name, as the blobs are built in parallel later.
+    """
+    existing = {path.name for path in directory.iterdir()}
+    fname = "{}.tar.zst".format(basename)
     num = 1
-    while fpath in directory.iterdir():
-        fpath = pathlib.Path("{}-{}.tar.bz2".format(basename, num))
+    while fname in existing:
+        fname = "{}-{}.tar.zst".format(basename, num)
         num += 1
-    return directory / fpath
+    fpath = directory / fname
+    fpath.touch(exist_ok=False)
+    return fpath
+
+
+class _FramedWriter:
+    """Write to the zstd stream, ending a frame every ZSTD_FRAME_SIZE of uncompressed data.
+
+    As the frames are independent, the blob can be decompressed in parallel, or from a frame
+    near the needed file instead of from the beginning.
+    """
+
+    def __init__(self, zstd_writer):
+        self._zstd_writer = zstd_writer
+        self._frame_size = 0
 
+    def write(self, data):
+        """Write the data, ending the current frame if big enough."""
+        self._zstd_writer.write(data)
+        self._frame_size += len(data)
+        if self._frame_size >= ZSTD_FRAME_SIZE:
+            self._zstd_writer.flush(zstandard.FLUSH_FRAME)
+            self._frame_size = 0
+        return len(data)
 
-def build_tree(rootdir, builddir, node, to_ignore):
-    """Build a whole subtree in a blob."""
-    sane_name = sanitize(str(node))
-    fname = _get_name(sane_name, builddir)
-    tar = tarfile.open(str(fname), 'x:bz2')
 
-    for dirpath, dirnames, filenames in os.walk(rootdir / node):
-        if pathlib.Path(dirpath) in to_ignore:
-            logger.debug("=== ignoring %r", dirpath)
-            dirnames.clear()
+@contextlib.contextmanager
+def _open_tar(tarfpath):
+    """Open a tar for streamed writing, compressed with zstd.
+
+    The compression is single threaded: the cores are already used building several blobs
+    at once, and the small frames would leave no room for zstd's multi-threaded jobs.
+    """
+    compressor = zstandard.ZstdCompressor(level=10)
+    with compressor.stream_writer(tarfpath.open('wb')) as zstd_writer:
+        tar = tarfile.open(
+            fileobj=_FramedWriter(zstd_writer), mode='w|',
+            bufsize=TAR_BUFSIZE, copybufsize=TAR_BUFSIZE)
+        with tar:
+            yield tar
+
+
+def _scan_files(dirpath, to_ignore):
+    """Yield the entries for all the files under the given directory, recursively.
+
+    Symlinks to directories are not followed (they are yielded as files), and unreadable
+    directories are skipped. Each directory's entries are walked in inode order (which comes
+    from the listing itself, no stat needed), as it's usually closer to their order in the
+    disk than the listing's one.
+    """
+    try:
+        with os.scandir(dirpath) as dir_iterator:
+            entries = sorted(dir_iterator, key=lambda entry: entry.inode())
+    except OSError as err:
+        logger.debug("=== skipped unreadable dir %r (%s)", dirpath, err)
+        return
+
+    for entry in entries:
+        if entry.path in to_ignore:
+            if _DEBUG:
+                logger.debug("=== ignoring %r", entry.path)
             continue
+        if entry.is_dir(follow_symlinks=False):
+            yield from _scan_files(entry.path, to_ignore)
+        else:
+            yield entry
 
-        for fname in filenames:
-            fpath = os.path.join(dirpath, fname)
-            if pathlib.Path(fpath) in to_ignore:
-                logger.debug("=== ignoring %r", fpath)
-                continue
-            if not os.access(fpath, os.R_OK):
-                logger.debug("=== skipped unreadable file %r", fpath)
-                continue
 
-            relative_path = str(pathlib.Path(fpath).relative_to(rootdir))
-            tar.add(fpath, arcname=relative_path)
-    tar.close()
+def _is_plain_file(stat_result):
+    """Tell if it's a regular file not hard linked elsewhere."""
+    return stat.S_ISREG(stat_result.st_mode) and stat_result.st_nlink == 1
 
 
-def pack_files(rootdir, builddir, all_files):
-    """Pack all files for a dir."""
-    if not all_files:
+def _add_file(tar, fpath, stat_result, arcname, content=None):
+    """Add the file to the tar, building its header from the already known stat.
+
+    This avoids the extra stat and the user/group names lookups done by `tar.add`, which is
+    still used for anything that is not a regular file or symlink, and for hard linked files
+    (so they are stored only once). If the content is given, the file is not read.
+    """
+    mode = stat_result.st_mode
+    if not (stat.S_ISLNK(mode) or _is_plain_file(stat_result)):
+        tar.add(fpath, arcname=arcname)
         return
 
-    tarfpath = _get_name('_packed_files', builddir)
-    tar = tarfile.open(str(tarfpath), 'x:bz2')
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.mode = stat.S_IMODE(mode)
+    tarinfo.uid = stat_result.st_uid
+    tarinfo.gid = stat_result.st_gid
+    tarinfo.mtime = stat_result.st_mtime
+    if stat.S_ISLNK(mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(fpath)
+        tar.addfile(tarinfo)
+    elif content is not None:
+        tarinfo.size = len(content)
+        tar.addfile(tarinfo, io.BytesIO(content))
+    else:
+        tarinfo.size = stat_result.st_size
+        with open(fpath, 'rb') as fh:
+            tar.addfile(tarinfo, fh)
+
+
+def _read_ahead(files, read_queue):
+    """Put the files in the queue along with their content if small (run in its own thread).
+
+    Big files are left to be read while being added, not to hold them in memory. When done,
+    None is put in the queue, or the error if something failed.
+    """
+    try:
+        for fpath, stat_result, arcname in files:
+            content = None
+            if _is_plain_file(stat_result) and stat_result.st_size <= READ_AHEAD_MAXSIZE:
+                try:
+                    with open(fpath, 'rb') as fh:
+                        content = fh.read()
+                except OSError:
+                    pass  # leave it to be handled when added
+            read_queue.put((fpath, stat_result, arcname, content))
+    except Exception as err:
+        read_queue.put(err)
+    else:
+        read_queue.put(None)
+
+
+def _build_blob(tarfpath, files):
+    """Build a blob with the files (path, stat and archive name for each).
+
+    The files are scanned and read in a separate thread, so the disk latency is hidden
+    while the previous ones are compressed.
+    """
+    read_queue = queue.Queue(maxsize=READ_AHEAD_QUEUE_SIZE)
+    reader = threading.Thread(target=_read_ahead, args=(files, read_queue), daemon=True)
+    reader.start()
+    with _open_tar(tarfpath) as tar:
+        while True:
+            item = read_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            _add_file(tar, *item)
+
+
+def _tree_files(rootdir, node, to_ignore):
+    """Yield path, stat and archive name of all the readable files in the subtree."""
+    # all scanned paths start with the root dir, so the archive name is just the rest
+    prefix_len = len(os.path.join(str(rootdir), ''))
+    for entry in _scan_files(str(rootdir / node), to_ignore):
+        if not os.access(entry.path, os.R_OK):
+            if _DEBUG:
+                logger.debug("=== skipped unreadable file %r", entry.path)
+            continue
+        yield entry.path, entry.stat(follow_symlinks=False), entry.path[prefix_len:]
+
+
+def _listed_files(rootdir, all_files):
+    """Yield path, stat and archive name of the given files that are readable.
+
+    They are yielded in inode order, which is usually closer to their order in the disk.
+    """
+    files = []
     for fname in all_files:
         fpath = str(rootdir / fname)
         if os.access(fpath, os.R_OK):
-            tar.add(fpath, arcname=str(fname))
-        else:
+            files.append((fpath, os.lstat(fpath), str(fname)))
+        elif _DEBUG:
             logger.debug("=== skipped unreadable file %r", fpath)
-    tar.close()
+    files.sort(key=lambda item: item[1].st_ino)
+    yield from files
+
+
+def _is_small_tree(dirpath, to_ignore, limit=SMALL_TREE_SIZE):
+    """Tell if the total size of the files in the tree is below the given limit.
+
+    Return as soon as the limit is reached, without scanning the rest of the tree. Files
+    removed while scanning are just skipped.
+    """
+    total = 0
+    for entry in _scan_files(dirpath, to_ignore):
+        try:
+            total += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            continue
+        if total >= limit:
+            return False
+    return True
+
+
+def _stamp_path(fpath):
+    """Get the path of the file holding the stamp of the given blob."""
+    return fpath.with_name(fpath.name + STAMP_SUFFIX)
+
+
+def _changed_since(dirpath, to_ignore, timestamp):
+    """Tell if anything inside the directory changed after the timestamp (in nanoseconds).
+
+    The change time is used instead of the modification one, as it's also updated on renames,
+    permission changes, or when the modification time is set back. Ignored nodes are not
+    checked; unreadable directories count as changed.
+    """
+    try:
+        with os.scandir(dirpath) as dir_iterator:
+            entries = list(dir_iterator)
+    except OSError:
+        return True
+
+    for entry in entries:
+        if entry.path in to_ignore:
+            continue
+        try:
+            entry_stat = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            # removed while checking
+            return True
+        if entry_stat.st_ctime_ns >= timestamp:
+            return True
+        if entry.is_dir(follow_symlinks=False) and _changed_since(
+                entry.path, to_ignore, timestamp):
+            return True
+    return False
+
+
+def _is_unchanged(node_path, to_ignore, ignored_inside, sync_fpath):
+    """Tell if the tree didn't change since its previously synced blob was built.
+
+    The stamp must be of the same tree (the blob name alone may be of a different one, as it
+    depends on sanitizing and collisions) and for the synced blob (by its digest, in case the
+    sync was interrupted); only then the tree is checked for changes.
+    """
+    sync_stamp_fpath = _stamp_path(sync_fpath)
+    needed = [sync_fpath, sync_stamp_fpath]
+    if not all(fpath.exists() for fpath in needed):
+        return False
+
+    try:
+        stamp = json.loads(sync_stamp_fpath.read_text())
+        previous = (stamp['node'], stamp['digest'], stamp['ignored'], int(stamp['start']))
+    except (ValueError, KeyError, TypeError):
+        return False
+    previous_node, previous_digest, previous_ignored, previous_start = previous
+    if previous_node != node_path or previous_ignored != ignored_inside:
+        return False
+    if previous_digest != _read_digest(sync_fpath):
+        return False
+    timestamp = previous_start - STAMP_MARGIN_NS
+    if os.stat(node_path).st_ctime_ns >= timestamp:
+        return False
+    return not _changed_since(node_path, to_ignore, timestamp)
+
+
+def _reuse_blob(tarfpath, sync_fpath):
+    """Put the previously synced blob, with its digest and stamp, in place of the new one."""
+    pairs = [
+        (tarfpath, sync_fpath),
+        (_digest_path(tarfpath), _digest_path(sync_fpath)),
+        (_stamp_path(tarfpath), _stamp_path(sync_fpath)),
+    ]
+    for build, sync in pairs:
+        build.unlink(missing_ok=True)
+        try:
+            os.link(sync, build)
+        except OSError:
+            # probably in different file systems
+            shutil.copy2(sync, build)
+
 
+def build_tree(rootdir, tarfpath, node, to_ignore, sync_fpath):
+    """Build a whole subtree in a blob.
 
-def explore(rootdir, builddir, group_levels, to_ignore, deep=0):
-    """Explore structure to build."""
+    If nothing in the subtree changed since the previously synced blob was built, that one
+    is reused instead.
+    """
+    node_path = str(rootdir / node)
+    ignored_inside = sorted(
+        path for path in to_ignore if path.startswith(os.path.join(node_path, '')))
+    if _is_unchanged(node_path, to_ignore, ignored_inside, sync_fpath):
+        logger.debug("=== reusing unchanged blob %r", str(sync_fpath))
+        _reuse_blob(tarfpath, sync_fpath)
+        return
+
+    start = time.time_ns()
+    _build_blob(tarfpath, _tree_files(rootdir, node, to_ignore))
+    digest = _digest(tarfpath)
+    _write_digest(tarfpath, digest)
+    stamp = {'node': node_path, 'start': start, 'digest': digest, 'ignored': ignored_inside}
+    _stamp_path(tarfpath).write_text(json.dumps(stamp))
+
+
+def pack_files(rootdir, tarfpath, all_files):
+    """Pack all files for a dir."""
+    _build_blob(tarfpath, _listed_files(rootdir, all_files))
+
+
+def explore(rootdir, builddir, syncdir, group_levels, to_ignore, executor, deep=0):
+    """Explore structure to build.
+
+    The blobs are built by the executor; return the futures for all of them. Nodes to ignore
+    are given as strings, to check them without building Paths. The sync dir is the one
+    corresponding to the build dir, where the previous blobs are.
+    """
     deepindent = " " * 4 * deep
     relative_levels = {
         str(k.relative_to(rootdir)): v
         for k, v in group_levels.items() if rootdir in k.parents or rootdir == k}
     logger.info("%sExploring %s (levels=%s)", deepindent, rootdir, relative_levels)
 
+    futures = []
     all_files = []
     for node in sorted(rootdir.iterdir()):
-        if node in to_ignore:
-            logger.debug("=== ignoring %r", str(node))
+        if str(node) in to_ignore:
+            if _DEBUG:
+                logger.debug("=== ignoring %r", str(node))
             continue
 
         node_relative = node.relative_to(rootdir)
@@ -128,19 +429,33 @@ def explore(rootdir, builddir, group_levels, to_ignore, deep=0):
             all_files.append(node_relative)
             continue
 
-        if any(group == node or group in node.parents for group in group_levels):
+        to_group = any(group == node or group in node.parents for group in group_levels)
+        if to_group and _is_small_tree(str(node), to_ignore):
+            logger.debug("%s    not going down on small tree %s", deepindent, node)
+            to_group = False
+
+        if to_group:
             logger.debug("%s    going down on %s", deepindent, node)
             build_sub = builddir / sanitize(str(node_relative))
             build_sub.mkdir()
+            sync_sub = syncdir / build_sub.name
             group_levels_sub = {k: v - 1 for k, v in group_levels.items() if v > 1}
-            explore(node, build_sub, group_levels_sub, to_ignore, deep=deep + 1)
+            futures.extend(explore(
+                node, build_sub, sync_sub, group_levels_sub, to_ignore, executor,
+                deep=deep + 1))
         else:
-            logger.info("%s    building tree for %s in %s", deepindent, node_relative, rootdir)
-            build_tree(rootdir, builddir, node_relative, to_ignore)
+            logger.info("%s    queued blob for tree %s in %s", deepindent, node_relative, rootdir)
+            tarfpath = _get_name(sanitize(str(node_relative)), builddir)
+            sync_fpath = syncdir / tarfpath.name
+            futures.append(executor.submit(
+                build_tree, rootdir, tarfpath, node_relative, to_ignore, sync_fpath))
 
-    logger.info("%s    packing %d files in %s", deepindent, len(all_files), rootdir)
-    pack_files(rootdir, builddir, all_files)
-    logger.info("%s    --- done", deepindent)
+    logger.info("%s    queued packing %d files in %s", deepindent, len(all_files), rootdir)
+    if all_files:
+        tarfpath = _get_name('_packed_files', builddir)
+        futures.append(executor.submit(pack_files, rootdir, tarfpath, all_files))
+    logger.info("%s    --- done exploring", deepindent)
+    return futures
 
 
 def compare_content(fpath1, fpath2):
@@ -148,15 +463,182 @@ def compare_content(fpath1, fpath2):
 
     This does not check modification times, just internal bytes.
     """
+    # read always in the same buffers, avoiding allocating new bytes for each block
+    buffer1 = bytearray(COMPARE_BLOCKSIZE)
+    buffer2 = bytearray(COMPARE_BLOCKSIZE)
     with open(fpath1, 'rb') as fh1:
         with open(fpath2, 'rb') as fh2:
             while True:
-                data1 = fh1.read(65536)
-                data2 = fh2.read(65536)
-                if data1 != data2:
+                read1 = fh1.readinto(buffer1)
+                read2 = fh2.readinto(buffer2)
+                if read1 != read2:
                     return False
-                if not data1:
+                if not read1:
                     return True
+                if read1 == COMPARE_BLOCKSIZE:
+                    equal = buffer1 == buffer2
+                else:
+                    equal = buffer1[:read1] == buffer2[:read2]
+                if not equal:
+                    return False
+
+
+def _digest_path(fpath):
+    """Get the path of the file holding the digest of the given one."""
+    return fpath.with_name(fpath.name + DIGEST_SUFFIX)
+
+
+def _digest(fpath):
+    """Get the BLAKE2 digest of the file's content."""
+    with open(fpath, 'rb') as fh:
+        return hashlib.file_digest(fh, 'blake2b').hexdigest()
+
+
+def _write_digest(fpath, digest):
+    """Store the file's digest next to it.
+
+    Any previous digest file is removed first, as it may be a hard link to a synced one.
+    """
+    digest_fpath = _digest_path(fpath)
+    digest_fpath.unlink(missing_ok=True)
+    fstat = fpath.stat()
+    digest_fpath.write_text("{} {} {}".format(digest, fstat.st_size, fstat.st_mtime_ns))
+
+
+def _read_digest(fpath):
+    """Get the stored digest of the file.
+
+    Return None if there is none, or if it's not for the file as it is now (by its size and
+    modification time), e.g. because the file was replaced or only partially synced.
+    """
+    try:
+        digest, size, mtime_ns = _digest_path(fpath).read_text().split()
+        fstat = fpath.stat()
+        stored = (int(size), int(mtime_ns))
+    except (FileNotFoundError, ValueError):
+        return None
+    if stored != (fstat.st_size, fstat.st_mtime_ns):
+        return None
+    return digest
+
+
+def get_status(build_fpath, build_size, build_digest, sync_fpath):
+    """Tell if the built file is 'new', 'changed' or 'equal' to the one previously synced.
+
+    The content of the synced file is not read if its digest was stored in a previous run
+    and is still valid.
+    """
+    try:
+        sync_size = sync_fpath.stat().st_size
+    except FileNotFoundError:
+        return 'new'
+    if sync_size != build_size:
+        return 'changed'
+
+    sync_digest = _read_digest(sync_fpath)
+    if sync_digest is None:
+        equal = compare_content(build_fpath, sync_fpath)
+    else:
+        equal = sync_digest == build_digest
+    return 'equal' if equal else 'changed'
+
+
+def _keep_synced(build_fpath, build_digest, sync_fpath):
+    """Give the built file (and its digest) the times of the equal one already synced.
+
+    This way the sync step sees them as unchanged and doesn't copy them again, so nothing is
+    uploaded for them. The digest file is stored again for the new times, and only gets the
+    times of the synced one if their content is the same.
+    """
+    sync_stat = sync_fpath.stat()
+    os.utime(build_fpath, ns=(sync_stat.st_atime_ns, sync_stat.st_mtime_ns))
+    _write_digest(build_fpath, build_digest)
+
+    build_digest_fpath = _digest_path(build_fpath)
+    sync_digest_fpath = _digest_path(sync_fpath)
+    try:
+        same_content = sync_digest_fpath.read_text() == build_digest_fpath.read_text()
+    except FileNotFoundError:
+        return
+    if same_content:
+        sync_stat = sync_digest_fpath.stat()
+        os.utime(build_digest_fpath, ns=(sync_stat.st_atime_ns, sync_stat.st_mtime_ns))
+
+
+def _copy_if_changed(build_fpath, sync_fpath):
+    """Copy the file keeping its times, unless the synced one has the same size and mtime."""
+    build_stat = build_fpath.stat()
+    try:
+        sync_stat = sync_fpath.stat()
+    except FileNotFoundError:
+        pass
+    else:
+        if (sync_stat.st_size, sync_stat.st_mtime_ns) == (
+                build_stat.st_size, build_stat.st_mtime_ns):
+            return
+    logger.debug("=== copying %r", str(build_fpath))
+    shutil.copy2(build_fpath, sync_fpath)
+
+
+def _remove(path):
+    """Remove the file or whole directory."""
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    else:
+        path.unlink()
+
+
+def _sync_order(path):
+    """Sort key to sync blobs (and dirs) first, then digests, then stamps.
+
+    This way, if the sync is interrupted, no blob is left with a digest or stamp that is not
+    for it: at most the digest is an old one, which is not trusted as it doesn't match the
+    blob's size and modification time.
+    """
+    if path.name.endswith(DIGEST_SUFFIX):
+        return 1
+    if path.name.endswith(STAMP_SUFFIX):
+        return 2
+    return 0
+
+
+def mirror(build_node, sync_node):
+    """Make the sync node the same as the built one, like `rsync -t -r --delete` would.
+
+    Only the files with different size or modification time are copied (which is done by
+    the kernel, without passing the content through Python); anything in the sync side
+    that is not in the built one is removed.
+    """
+    if not build_node.is_dir():
+        if sync_node.is_dir():
+            _remove(sync_node)
+        _copy_if_changed(build_node, sync_node)
+        return
+
+    if sync_node.exists() and not sync_node.is_dir():
+        _remove(sync_node)
+    sync_node.mkdir(exist_ok=True)
+
+    build_children = sorted(build_node.iterdir(), key=_sync_order)
+    build_names = set()
+    for build_child in build_children:
+        build_names.add(build_child.name)
+        mirror(build_child, sync_node / build_child.name)
+    for sync_child in sync_node.iterdir():
+        if sync_child.name not in build_names:
+            logger.debug("=== removing %r", str(sync_child))
+            _remove(sync_child)
+
+
+def _init_worker(log_level):
+    """Set up the logging of a worker process as it is in the main one.
+
+    Needed as the workers may not be forked (so they don't inherit what was set after
+    parsing the command line).
+    """
+    global _DEBUG
+    logger.setLevel(log_level)
+    _DEBUG = logger.isEnabledFor(logging.DEBUG)
 
 
 def main(config_file):
@@ -232,23 +714,39 @@ def main(config_file):
         logger.debug("Removing old build dir")
         shutil.rmtree(builddir)
     os.makedirs(builddir)
-    explore(rootdir, builddir, group_levels, to_ignore)
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=os.cpu_count(), initializer=_init_worker, initargs=(logger.level,))
+    with executor:
+        to_ignore_strs = frozenset(str(node) for node in to_ignore)
+        futures = explore(rootdir, builddir, syncdir, group_levels, to_ignore_strs, executor)
+        logger.info("Waiting for %d blobs to be built", len(futures))
+        for future in futures:
+            future.result()
+        logger.info("All blobs built")
 
     # stats
     all_stats = []
-    for dirpath, dirnames, filenames in os.walk(str(builddir)):
-        dirpath = pathlib.Path(dirpath)
-        sync_dirpath = syncdir / dirpath.relative_to(builddir)
-
-        for fname in filenames:
-            build_fpath = dirpath / fname
-            sync_fpath = sync_dirpath / fname
-            if sync_fpath.exists():
-                status = 'equal' if compare_content(build_fpath, sync_fpath) else 'changed'
-            else:
-                status = 'new'
-            size = build_fpath.stat().st_size
-            all_stats.append((build_fpath.relative_to(builddir), size, status))
+    for entry in _scan_files(str(builddir), frozenset()):
+        if entry.name.endswith((DIGEST_SUFFIX, STAMP_SUFFIX)):
+            continue
+        build_fpath = pathlib.Path(entry.path)
+        relative_fpath = build_fpath.relative_to(builddir)
+        sync_fpath = syncdir / relative_fpath
+        size = entry.stat(follow_symlinks=False).st_size
+
+        # store the digest next to the built file, so it's synced and used in next run (unless
+        # it's already there, as tree blobs get it when built or reused)
+        build_digest = _read_digest(build_fpath)
+        if build_digest is None:
+            build_digest = _digest(build_fpath)
+            _write_digest(build_fpath, build_digest)
+
+        status = get_status(build_fpath, size, build_digest, sync_fpath)
+        if status == 'equal':
+            _keep_synced(build_fpath, build_digest, sync_fpath)
+        if _DEBUG:
+            logger.debug("=== stats for %r: size=%d status=%s", str(relative_fpath), size, status)
+        all_stats.append((relative_fpath, size, status))
 
     tot_sizes = sum(x[1] for x in all_stats) / GB
     tot_files = len(all_stats)
@@ -264,10 +762,9 @@ def main(config_file):
 
     # copy
     logger.info("Copying to sync destination")
-    for node in builddir.iterdir():
-        cmd = ['rsync', '-t', '-r', '--delete', '--inplace', str(node), str(syncdir)]
-        logger.debug("Running external %s", cmd)
-        subprocess.run(cmd, check=True)
+    syncdir.mkdir(parents=True, exist_ok=True)
+    for node in sorted(builddir.iterdir(), key=_sync_order):
+        mirror(node, syncdir / node.name)
 
     logger.info("Done")
 
@@ -280,6 +777,7 @@ if __name__ == '__main__':
 
     if args.verbose:
         logger.setLevel(logging.DEBUG)
+        _DEBUG = True
 
     logger.info("Loading config from %r", args.config)
     main(args.config)